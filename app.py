@@ -9,7 +9,12 @@ from authlib.integrations.flask_client import OAuth
 from dotenv import load_dotenv
 
 from auth import AuthError, requires_auth, requires_signed_in
-from models import setup_db, Movie, Actor, db
+from auth import permission_registry, ANY_SIGNED_IN
+from idempotency import IdempotencyStore, idempotent
+from query_budget import init_query_budget, query_budget
+from models import setup_db, movie_stats, movie_rows, movie_row
+from models import format_movie_row, Movie, Actor, db
+from snapshot import MOVIE_SNAPSHOT, SNAPSHOT_LOAD_QUERIES, MovieSnapshot
 
 load_dotenv()
 
@@ -25,13 +30,20 @@ def create_app(test_config=None):
     
     app = Flask(__name__)
     app.secret_key = "super secret key"
+    if test_config is not None:
+        app.config.update(test_config)
+    app.config.setdefault('MOVIE_SNAPSHOT', MOVIE_SNAPSHOT)
+    snapshot_enabled = app.config['MOVIE_SNAPSHOT']
     setup_db(app)
+    init_query_budget(app)
+    idempotency_store = IdempotencyStore()
+    movie_snapshot = MovieSnapshot() if snapshot_enabled else None
     CORS(app, resources={r"/api/*": {"origins": "*"}})
 
     @app.after_request
     def after_request(response):
         response.headers.add('Access-Control-Allow-Headers',
-                             'Content-Type,Authorization,true')
+                             'Content-Type,Authorization,Idempotency-Key,true')
         response.headers.add('Access-Control-Allow-Methods',
                              'GET,PATCH,POST,DELETE,OPTIONS')
         return response
@@ -53,17 +65,20 @@ def create_app(test_config=None):
 # API Endpoints
 #----------------------------------------------------------------------------#
     @app.route('/', methods=['GET'])
+    @query_budget(0)
     def index():
         '''Home page route'''
         return render_template('index.html')
 
     @app.route('/login')
+    @query_budget(0)
     def login():
         # Login URL Format:
         # AUTH0_BASE_URL + 'authorize?audience=' + API_AUDIENCE + '&response_type=token&client_id=' + AUTH0_CLIENT_ID + '&redirect_uri=' + AUTH0_CALLBACK_URL
         return auth0.authorize_redirect(redirect_uri=AUTH0_CALLBACK_URL, audience=API_AUDIENCE)
 
     @app.route('/callback')
+    @query_budget(0)
     def callback():
         # Handles callback response from Auth0
         res = auth0.authorize_access_token()
@@ -75,6 +90,7 @@ def create_app(test_config=None):
         return redirect('/jwtcontrol')
 
     @app.route('/logout')
+    @query_budget(0)
     def logout():
         session.clear()
         params = {'returnTo': url_for('index', _external=True), 'client_id': AUTH0_CLIENT_ID}
@@ -82,34 +98,73 @@ def create_app(test_config=None):
     
     @app.route('/jwtcontrol')
     @requires_signed_in
+    @query_budget(0)
     def jwtcontrol():
         return render_template('jwtcontrol.html', token=session['jwt_token'])
 
+    @app.route('/permissions', methods=['GET'])
+    @requires_auth(ANY_SIGNED_IN)
+    @query_budget(0)
+    def get_permissions(jwt):
+        '''Return every route with its methods and required permission'''
+
+        return jsonify({
+            'success': True,
+            'routes': route_permissions
+        }), 200
+
 #----------------------------------------------------------------------------#
 # Movie Routes
 #----------------------------------------------------------------------------#
     @app.route('/movies', methods=['GET'])
     @requires_auth('get:movies')
+    @query_budget(SNAPSHOT_LOAD_QUERIES if snapshot_enabled else 1)
     def get_movies(jwt):
-        '''Return all movies from database'''
+        '''Return all movies from database or from the movie snapshot'''
+
+        try:
+            if movie_snapshot is not None:
+                movie_snapshot.refresh()
+                movies = movie_snapshot.all()
+            else:
+                movies = [format_movie_row(row) for row in movie_rows()]
+
+            return jsonify({
+                'success': True,
+                'movies': movies
+            }), 200
+        except Exception as e:
+            abort(500)
+
+    @app.route('/movies/stats', methods=['GET'])
+    @requires_auth('get:movies')
+    @query_budget(1)
+    def get_movie_stats(jwt):
+        '''Return movie counts per release year and per decade'''
 
         try:
-            movies = Movie.query.all()
+            stats = movie_stats()
 
             return jsonify({
                 'success': True,
-                'movies': [movie.format() for movie in movies]
+                'stats': stats
             }), 200
         except Exception as e:
             abort(500)
 
     @app.route('/movies/<int:id>', methods=['GET'])
     @requires_auth('get:movies')
+    @query_budget(SNAPSHOT_LOAD_QUERIES if snapshot_enabled else 1)
     def get_movie_by_id(jwt, id):
-        '''Return movie matching the id'''
+        '''Return movie matching the id from database or from the movie snapshot'''
 
         try:
-            movie = Movie.query.get(id)
+            if movie_snapshot is not None:
+                movie_snapshot.refresh()
+                movie = movie_snapshot.get(id)
+            else:
+                row = movie_row(id)
+                movie = format_movie_row(row) if row is not None else None
         except Exception as e:
             abort(422)
 
@@ -119,11 +174,13 @@ def create_app(test_config=None):
         else:
             return jsonify({
                 'success': True,
-                'movie': movie.format()
+                'movie': movie
             }), 200
 
     @app.route('/movies', methods=['POST'])
     @requires_auth('post:movies')
+    @query_budget(4 if snapshot_enabled else 3)
+    @idempotent(idempotency_store)
     def add_movie(jwt):
         """Create and insert new movie into database"""
 
@@ -148,6 +205,7 @@ def create_app(test_config=None):
 
     @app.route('/movies/<int:id>', methods=['PATCH'])
     @requires_auth('patch:movies')
+    @query_budget(6 if snapshot_enabled else 5)
     def update_movie(jwt, id):
         '''Update movie info in database'''
 
@@ -156,7 +214,9 @@ def create_app(test_config=None):
         release_date = data.get('release_date', None)
 
         try:
-            movie = Movie.query.get(id)
+            # Lock the row so the stored release year adjusted in
+            # movie_year_counts cannot change under an overlapping request
+            movie = Movie.query.with_for_update().get(id)
         except:
             abort(500)
 
@@ -181,11 +241,14 @@ def create_app(test_config=None):
 
     @app.route('/movies/<int:id>', methods=['DELETE'])
     @requires_auth('delete:movies')
+    @query_budget(4 if snapshot_enabled else 3)
     def delete_movie(jwt, id):
         '''Delete movie matching id from database'''
 
         try:
-            movie = Movie.query.get(id)
+            # Lock the row so the stored release year adjusted in
+            # movie_year_counts cannot change under an overlapping request
+            movie = Movie.query.with_for_update().get(id)
         except:
             abort(500)
 
@@ -221,6 +284,14 @@ def create_app(test_config=None):
             "message": "unprocessable"
         }), 422
 
+    @app.errorhandler(409)
+    def conflict(error):
+        return jsonify({
+            "success": False,
+            "error": 409,
+            "message": "conflict"
+        }), 409
+
     @app.errorhandler(500)
     def server_error(error):
         return jsonify({
@@ -265,6 +336,9 @@ def create_app(test_config=None):
         response.status_code = exception.status_code
         return response
 
+    # Compiled once all routes are registered, served by get_permissions
+    route_permissions = permission_registry(app)
+
     return app
 
 APP = create_app()
@@ -1,5 +1,8 @@
 import os
 import json
+import time
+import threading
+from collections import OrderedDict
 from flask import request, _request_ctx_stack, abort, redirect, session
 from functools import wraps
 from jose import jwt
@@ -15,6 +18,10 @@ load_dotenv()
 AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
 ALGORITHMS = ['RS256']
 API_AUDIENCE=os.environ['API_AUDIENCE']
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 1000))
+
+# Pass to requires_auth for routes open to any user with a valid token
+ANY_SIGNED_IN = '*'
 
 #----------------------------------------------------------------------------#
 # Implement JWT authorization
@@ -57,10 +64,11 @@ def get_token_auth_header():
 
   return header_parts[1]
 
-def check_permissions(permission, payload):
+def check_permissions(permission, payload, granted=None):
   '''@INPUTS
-    permission: string permission (i.e. 'get:movies')
+    permission: string permission (i.e. 'get:movies'), ANY_SIGNED_IN for any signed in user
     payload: decoded JWT payload
+    granted: frozenset of the payload permissions, built from payload if None
 
     Response:
         Raises an AuthError if the permissions are not included in the payload
@@ -73,7 +81,10 @@ def check_permissions(permission, payload):
         'description': 'Permissions not included in JWT.'
     }, 400)
 
-  if permission not in payload['permissions']:
+  if granted is None:
+    granted = frozenset(payload['permissions'])
+
+  if permission != ANY_SIGNED_IN and permission not in granted:
       raise AuthError({
           'code': 'unauthorized',
           'description': 'Permission not found.'
@@ -153,33 +164,101 @@ def verify_decode_jwt(token):
         'description': 'Unable to find the appropriate key.'
         }, 400)
 
+#----------------------------------------------------------------------------#
+# Cache decoded tokens
+#----------------------------------------------------------------------------#
+
+_token_cache = OrderedDict()
+_token_cache_lock = threading.Lock()
+
+def verify_decode_jwt_cached(token):
+  '''@INPUTS
+    token: a JSON web token (JWT) string
+
+    Request:
+        Returns the cached result if the token was already verified and has not expired
+        Otherwise verifies the token with verify_decode_jwt and caches it until its exp claim
+        At most TOKEN_CACHE_SIZE tokens are kept, the least recently used are evicted
+
+    Response:
+        Returns the decoded payload and its permissions as a frozenset
+        (None if the payload has no permissions claim)
+        If not valid, raises AuthError exception
+  '''
+  now = time.time()
+  with _token_cache_lock:
+    cached = _token_cache.get(token)
+    if cached is not None:
+      payload, granted, expires = cached
+      if now < expires:
+        _token_cache.move_to_end(token)
+        return payload, granted
+      del _token_cache[token]
+
+  payload = verify_decode_jwt(token)
+  granted = None
+  if 'permissions' in payload:
+    granted = frozenset(payload['permissions'])
+
+  if 'exp' in payload:
+    with _token_cache_lock:
+      _token_cache[token] = (payload, granted, payload['exp'])
+      while len(_token_cache) > TOKEN_CACHE_SIZE:
+        _token_cache.popitem(last=False)
+
+  return payload, granted
+
 def requires_auth(permission=''):
   '''@INPUTS
-    permission: string permission (i.e. get:movies)
+    permission: string permission (i.e. get:movies), ANY_SIGNED_IN for any signed in user
+        The default '' is never granted, so a route missing its permission rejects every token
 
     Request:
         The get_token_auth_header method gets the token
-        The verify_decode_jwt method decodes the JWT
+        The verify_decode_jwt_cached method decodes the JWT once per token
         The check_permissions method validates the claims and checks the requested permission
 
     Response:
         Returns the decorator which passes the decoded payload to the decorated method
+        The permission is kept on the decorated method for permission_registry
   '''
   def requires_auth_decorator(f):
       @wraps(f)
       def wrapper(*args, **kwargs):
         try:
             token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            payload, granted = verify_decode_jwt_cached(token)
+            check_permissions(permission, payload, granted)
         except AuthError as err:
             abort(401, err.error)
 
         return f(payload, *args, **kwargs)
 
+      wrapper.required_permission = permission
       return wrapper
   return requires_auth_decorator
 
+def permission_registry(app):
+  '''@INPUTS
+    app: the Flask app with all its routes registered
+
+    Response:
+        Returns a list with the route, methods and required permission of every route
+        The permission is None for routes not wrapped by requires_auth
+        and ANY_SIGNED_IN ('*') for routes open to any signed in user
+  '''
+  registry = []
+  for rule in sorted(app.url_map.iter_rules(), key=lambda rule: rule.rule):
+    if rule.endpoint == 'static':
+      continue
+    view = app.view_functions[rule.endpoint]
+    registry.append({
+        'route': rule.rule,
+        'methods': sorted(rule.methods - {'HEAD', 'OPTIONS'}),
+        'permission': getattr(view, 'required_permission', None)
+    })
+  return registry
+
 def requires_signed_in(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -0,0 +1,80 @@
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from flask import Flask
+
+#----------------------------------------------------------------------------#
+# Compare ORM and Core read costs per movie row
+#   python benchmark.py [number_of_movies]
+# Runs against an in-memory SQLite database so it never touches real data
+#----------------------------------------------------------------------------#
+
+os.environ['DATABASE_URL'] = 'sqlite://'
+os.environ.pop('ENV', None)
+
+from models import setup_db, db, Movie
+from models import movie_rows, movie_row, format_movie_row
+
+REPEAT = 5
+
+def best_of(fn):
+    '''Return the fastest of REPEAT runs of fn in seconds'''
+    times = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def orm_all():
+    [movie.format() for movie in Movie.query.all()]
+    db.session.remove()
+
+def core_all():
+    [format_movie_row(row) for row in movie_rows()]
+    db.session.remove()
+
+def orm_by_id(ids):
+    def run():
+        for id in ids:
+            Movie.query.get(id).format()
+        db.session.remove()
+    return run
+
+def core_by_id(ids):
+    def run():
+        for id in ids:
+            format_movie_row(movie_row(id))
+        db.session.remove()
+    return run
+
+def main(count):
+    app = Flask(__name__)
+    setup_db(app, 'sqlite://')
+
+    with app.app_context():
+        db.create_all()
+        db.session.execute(Movie.__table__.insert(), [
+            {
+                'title': f'Movie {i}',
+                'release_date': datetime(1950, 1, 1) + timedelta(days=i)
+            }
+            for i in range(count)
+        ])
+        db.session.commit()
+
+        ids = list(range(1, min(count, 1000) + 1))
+        results = [
+            ('get_movies ORM', best_of(orm_all), count),
+            ('get_movies Core', best_of(core_all), count),
+            ('get_movie_by_id ORM', best_of(orm_by_id(ids)), len(ids)),
+            ('get_movie_by_id Core', best_of(core_by_id(ids)), len(ids)),
+        ]
+
+    print(f'{count} movies, best of {REPEAT} runs')
+    for name, seconds, rows in results:
+        print(f'{name:<22} {seconds * 1e6 / rows:8.2f} us per row')
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
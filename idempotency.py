@@ -0,0 +1,190 @@
+import os
+import time
+import hashlib
+from datetime import datetime, timedelta
+from functools import wraps
+from flask import request, abort, make_response
+from sqlalchemy import and_, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from models import db, IdempotencyKey
+from query_budget import allow_queries
+
+#----------------------------------------------------------------------------#
+# Configure idempotency constants
+#----------------------------------------------------------------------------#
+
+IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', 24 * 60 * 60))
+IDEMPOTENCY_WAIT = int(os.getenv('IDEMPOTENCY_WAIT', 30))
+IDEMPOTENCY_POLL = 0.1
+
+#----------------------------------------------------------------------------#
+# Idempotency key store
+#----------------------------------------------------------------------------#
+
+class IdempotencyStore:
+    '''
+    IdempotencyStore
+    Responses keyed by Idempotency-Key in the idempotency_keys table, shared
+    by every server process
+    A key row is inserted when its first request starts and holds the
+    response once it finishes. Rows expire after ttl seconds
+    In flight rows older than wait seconds belong to a process that died
+    and are taken over by the next retry
+    Each step commits on its own connection, apart from the route's
+    transaction, so other processes see it straight away
+    '''
+    def __init__(self, ttl=IDEMPOTENCY_TTL, wait=IDEMPOTENCY_WAIT):
+        self.ttl = timedelta(seconds=ttl)
+        self.wait = timedelta(seconds=wait)
+
+    '''
+    begin(key, fingerprint)
+        Returns (None, True) if the caller owns the key and must run the request
+        Returns (row, False) with the stored key if another request holds it
+        The row is None if the key was released in the meantime
+    '''
+    def begin(self, key, fingerprint):
+        table = IdempotencyKey.__table__
+        sub, path, idempotency_key = key
+        now = datetime.utcnow()
+
+        with db.engine.begin() as connection:
+            # created_at is indexed, so this only reads the expired rows
+            self._execute(connection, table.delete().where(
+                table.c.created_at < now - self.ttl
+            ))
+            self._execute(connection, table.delete().where(and_(
+                self._match(key),
+                table.c.status_code.is_(None),
+                table.c.created_at < now - self.wait
+            )))
+
+            inserted = self._execute(connection, pg_insert(table).values(
+                sub=sub,
+                path=path,
+                key=idempotency_key,
+                fingerprint=fingerprint,
+                created_at=now
+            ).on_conflict_do_nothing())
+            if inserted.rowcount == 1:
+                return None, True
+
+            row = self._execute(
+                connection, select(table).where(self._match(key))
+            ).first()
+            return row, False
+
+    '''
+    complete(key, response)
+        Stores the (data, status_code, mimetype) response for the key
+    '''
+    def complete(self, key, response):
+        table = IdempotencyKey.__table__
+        data, status_code, mimetype = response
+
+        with db.engine.begin() as connection:
+            self._execute(connection, table.update().where(and_(
+                self._match(key),
+                table.c.status_code.is_(None)
+            )).values(body=data, status_code=status_code, mimetype=mimetype))
+
+    '''
+    release(key)
+        Forgets the key after a failed request so a retry runs it again
+        Rolls back the route's session first, the request is over
+    '''
+    def release(self, key):
+        table = IdempotencyKey.__table__
+        db.session.rollback()
+
+        with db.engine.begin() as connection:
+            self._execute(connection, table.delete().where(and_(
+                self._match(key),
+                table.c.status_code.is_(None)
+            )))
+
+    def _match(self, key):
+        table = IdempotencyKey.__table__
+        sub, path, idempotency_key = key
+        return and_(
+            table.c.sub == sub,
+            table.c.path == path,
+            table.c.key == idempotency_key
+        )
+
+    def _execute(self, connection, statement):
+        # Statements run for the key are not part of the route's budget
+        allow_queries(1)
+        return connection.execute(statement)
+
+#----------------------------------------------------------------------------#
+# Idempotent route decorator
+#----------------------------------------------------------------------------#
+
+def idempotent(store):
+    '''@INPUTS
+    store: the IdempotencyStore holding the responses
+
+    Request:
+        Without an Idempotency-Key header the route runs as usual
+        Keys are scoped to the token subject and the request path
+        A repeated key returns the stored response without running the route
+        A repeated key still in flight waits for the first request to finish
+        A repeated key sent with a different body aborts with 422
+
+    Response:
+        Returns the decorator for a route already wrapped by requires_auth
+        Only successful responses are stored
+    '''
+    def idempotent_decorator(f):
+        @wraps(f)
+        def wrapper(jwt, *args, **kwargs):
+            idempotency_key = request.headers.get('Idempotency-Key', None)
+            if not idempotency_key:
+                return f(jwt, *args, **kwargs)
+
+            key = (jwt.get('sub') or '', request.path, idempotency_key)
+            fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+
+            deadline = time.monotonic() + IDEMPOTENCY_WAIT
+            while True:
+                row, owner = store.begin(key, fingerprint)
+                if owner:
+                    break
+                # The first request failed and released the key, try again
+                if row is None:
+                    continue
+                if row.fingerprint != fingerprint:
+                    abort(422)
+                if row.status_code is not None:
+                    return replay(row)
+                if time.monotonic() >= deadline:
+                    abort(409)
+                time.sleep(IDEMPOTENCY_POLL)
+
+            try:
+                response = make_response(f(jwt, *args, **kwargs))
+            except BaseException:
+                store.release(key)
+                raise
+
+            if response.status_code < 400:
+                store.complete(key, (
+                    response.get_data(),
+                    response.status_code,
+                    response.mimetype
+                ))
+            else:
+                store.release(key)
+            return response
+
+        return wrapper
+    return idempotent_decorator
+
+def replay(row):
+    '''Rebuild a stored response, marking it as a replay'''
+    response = make_response(row.body, row.status_code)
+    response.mimetype = row.mimetype
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
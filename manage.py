@@ -2,7 +2,7 @@ from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
 from app import create_app
-from models import db, Movie, Actor
+from models import db, rebuild_movie_stats, Movie, Actor
 
 app = create_app()
 
@@ -19,5 +19,10 @@ def seed():
     Actor(name='Timothee Chalamet', age=26, gender='male').insert()
     Actor(name='Zachary Quinto', age=44, gender='male').insert()
 
+@manager.command
+def rebuild_stats():
+    '''Recompute the movie_year_counts summary table from scratch'''
+    rebuild_movie_stats()
+
 if __name__ == '__main__':
     manager.run()
\ No newline at end of file
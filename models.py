@@ -1,7 +1,12 @@
 import os
-from sqlalchemy import Column, String, Integer, DateTime, create_engine
+from sqlalchemy import Column, String, Integer, DateTime, LargeBinary, create_engine
+from sqlalchemy import extract, func, orm, select, bindparam
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
+from dateutil import parser as date_parser
+from datetime import datetime
 import json
 from dotenv import load_dotenv
 
@@ -43,6 +48,63 @@ def db_drop_and_create():
     db.drop_all()
     db.create_all()
 
+'''
+release_year(release_date)
+    Returns the year of a release date
+    Accepts a datetime or a date string as sent by the API (i.e. '2020-09-30')
+'''
+def release_year(release_date):
+    if isinstance(release_date, str):
+        release_date = date_parser.parse(release_date)
+    return release_date.year
+
+'''
+log_movie_change(movie_id)
+    Records a movie write in movie_changes for the movie snapshot
+    Skipped unless the app config has MOVIE_SNAPSHOT set, so the log is
+    only written (and pruned) when a snapshot reads it
+    The caller commits along with the movie change
+'''
+def log_movie_change(movie_id):
+    if current_app.config.get('MOVIE_SNAPSHOT'):
+        db.session.add(MovieChange(movie_id=movie_id))
+
+'''
+rebuild_movie_stats()
+    Recomputes the movie_year_counts summary table from the movies table
+'''
+def rebuild_movie_stats():
+    year = extract('year', Movie.release_date)
+    rows = db.session.query(year, func.count(Movie.id)).group_by(year).all()
+
+    MovieYearCount.query.delete()
+    for movie_year, count in rows:
+        db.session.add(MovieYearCount(year=int(movie_year), count=count))
+    db.session.commit()
+
+'''
+movie_stats()
+    Returns movie counts per release year and per decade
+    Reads only the summary table so the cost does not grow with the catalog
+'''
+def movie_stats():
+    rows = MovieYearCount.query.filter(MovieYearCount.count > 0) \
+        .order_by(MovieYearCount.year).all()
+
+    decades = {}
+    for row in rows:
+        decade = row.year - row.year % 10
+        decades[decade] = decades.get(decade, 0) + row.count
+
+    return {
+        'total_movies': sum(row.count for row in rows),
+        'years': [row.format() for row in rows],
+        'decades': [
+            {'decade': decade, 'count': count}
+            for decade, count in decades.items()
+        ]
+    }
+
 #----------------------------------------------------------------------------#
 # Movie table
 #----------------------------------------------------------------------------#
@@ -56,31 +118,63 @@ class Movie(db.Model):
     def __init__(self, title, release_date):
         self.title = title
         self.release_date = release_date
+        self._stats_year = None
+
+    '''
+    init_on_load()
+        Remembers the stored release year so writes can adjust movie_year_counts
+        update() and delete() rely on it, so load the movie with
+        Movie.query.with_for_update() to read the year under a row lock
+    '''
+    @orm.reconstructor
+    def init_on_load(self):
+        self._stats_year = self.release_date.year
     
     '''
     insert()
         Inserts a new movie into the database
         The title and release date must not be null
+        Increments the count for the release year in movie_year_counts
+        Records the change in movie_changes when the movie snapshot is on
     '''
     def insert(self):
+        year = release_year(self.release_date)
         db.session.add(self)
+        db.session.flush()
+        MovieYearCount.adjust(year, 1)
+        log_movie_change(self.id)
         db.session.commit()
+        self._stats_year = year
 
     '''
     update()
         Updates fields of an existing movie
         The title and relase date must not be null
+        Moves the movie to its new release year in movie_year_counts
+        The movie must have been loaded with Movie.query.with_for_update()
+        Records the change in movie_changes when the movie snapshot is on
     '''
     def update(self):
+        year = release_year(self.release_date)
+        if year != self._stats_year:
+            MovieYearCount.adjust(self._stats_year, -1)
+            MovieYearCount.adjust(year, 1)
+        log_movie_change(self.id)
         db.session.commit()
+        self._stats_year = year
 
     '''
     delete()
         Deletes a movie from the database matching the sent id
         If the movie does not exist a 404 error is sent
+        Decrements the count for the release year in movie_year_counts
+        The movie must have been loaded with Movie.query.with_for_update()
+        Records the change in movie_changes when the movie snapshot is on
     '''
     def delete(self):
         db.session.delete(self)
+        MovieYearCount.adjust(self._stats_year, -1)
+        log_movie_change(self.id)
         db.session.commit()
 
     '''
@@ -95,4 +189,153 @@ class Movie(db.Model):
         }
 
     def __repr__(self):
-        return f'id: {self.id} title: {self.title} release date: {self.release_date}'
\ No newline at end of file
+        return f'id: {self.id} title: {self.title} release date: {self.release_date}'
+
+#----------------------------------------------------------------------------#
+# Movie read statements
+#----------------------------------------------------------------------------#
+'''
+Core select() statements for the read only movie routes
+    Built once at import so each request reuses the statement and its
+    compiled SQL from the engine's compiled cache
+    Rows come back as plain tuples, skipping ORM instance construction
+    The write routes keep using the Movie model
+'''
+movie_columns = (
+    Movie.__table__.c.id,
+    Movie.__table__.c.title,
+    Movie.__table__.c.release_date
+)
+select_movies = select(*movie_columns).order_by(Movie.__table__.c.id)
+select_movie_by_id = select(*movie_columns) \
+    .where(Movie.__table__.c.id == bindparam('id'))
+select_movies_by_ids = select(*movie_columns) \
+    .where(Movie.__table__.c.id.in_(bindparam('ids', expanding=True)))
+
+'''
+movie_rows()
+    Returns (id, title, release_date) rows for all movies ordered by id
+'''
+def movie_rows():
+    return db.session.execute(select_movies).all()
+
+'''
+movie_row(id)
+    Returns the (id, title, release_date) row matching the id, or None
+'''
+def movie_row(id):
+    return db.session.execute(select_movie_by_id, {'id': id}).first()
+
+'''
+movie_rows_by_ids(ids)
+    Returns (id, title, release_date) rows for the movies matching the ids
+'''
+def movie_rows_by_ids(ids):
+    return db.session.execute(select_movies_by_ids, {'ids': list(ids)}).all()
+
+'''
+format_movie_row(row)
+    returns a movie row as an object, matching Movie.format()
+'''
+def format_movie_row(row):
+    return {
+        'id': row[0],
+        'title': row[1],
+        'release_date': row[2]
+    }
+
+#----------------------------------------------------------------------------#
+# Movie year counts summary table
+#----------------------------------------------------------------------------#
+class MovieYearCount(db.Model):
+    __tablename__ = 'movie_year_counts'
+
+    year = Column(Integer, primary_key=True, autoincrement=False)
+    count = Column(Integer, nullable=False, default=0)
+
+    def __init__(self, year, count):
+        self.year = year
+        self.count = count
+
+    '''
+    adjust(year, delta)
+        Adds delta to the count for the year inside the current transaction
+        The change runs in SQL so concurrent writers do not lose updates
+        Increments are an INSERT ... ON CONFLICT DO UPDATE so two writers
+        creating the row for a new year do not collide on the primary key
+        The caller commits along with the movie change
+    '''
+    @staticmethod
+    def adjust(year, delta):
+        table = MovieYearCount.__table__
+        if delta > 0:
+            statement = pg_insert(table).values(year=year, count=delta)
+            statement = statement.on_conflict_do_update(
+                index_elements=[table.c.year],
+                set_={'count': table.c.count + delta}
+            )
+        else:
+            statement = table.update() \
+                .where(table.c.year == year) \
+                .values(count=table.c.count + delta)
+        db.session.execute(statement)
+
+    '''
+    format()
+        returns the year count as an object
+    '''
+    def format(self):
+        return {
+            'year': self.year,
+            'count': self.count
+        }
+
+    def __repr__(self):
+        return f'year: {self.year} count: {self.count}'
+
+#----------------------------------------------------------------------------#
+# Movie change log
+#----------------------------------------------------------------------------#
+class MovieChange(db.Model):
+    __tablename__ = 'movie_changes'
+
+    id = Column(Integer, primary_key=True)
+    movie_id = Column(Integer, nullable=False)
+    created_at = Column(DateTime(), nullable=False, default=datetime.utcnow,
+                        index=True)
+
+    def __init__(self, movie_id):
+        self.movie_id = movie_id
+
+    '''
+    prune(before)
+        Deletes the changes created before the datetime (UTC)
+        The caller commits
+    '''
+    @staticmethod
+    def prune(before):
+        MovieChange.query.filter(MovieChange.created_at < before) \
+            .delete(synchronize_session=False)
+
+    def __repr__(self):
+        return f'id: {self.id} movie id: {self.movie_id}'
+#----------------------------------------------------------------------------#
+# Idempotency keys
+#----------------------------------------------------------------------------#
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+
+    # A key is scoped to the token subject and the request path
+    sub = Column(String, primary_key=True)
+    path = Column(String, primary_key=True)
+    key = Column(String, primary_key=True)
+    fingerprint = Column(String, nullable=False)
+    # The stored response, null while the first request is in flight
+    status_code = Column(Integer)
+    body = Column(LargeBinary)
+    mimetype = Column(String)
+    created_at = Column(DateTime(), nullable=False, default=datetime.utcnow,
+                        index=True)
+
+    def __repr__(self):
+        return f'sub: {self.sub} path: {self.path} key: {self.key}'
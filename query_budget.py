@@ -0,0 +1,89 @@
+import os
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+#----------------------------------------------------------------------------#
+# Count SQL statements per request
+#----------------------------------------------------------------------------#
+
+class QueryBudgetExceeded(AssertionError):
+    '''
+    QueryBudgetExceeded Exception
+    Raised in testing when a route runs more SQL statements than its budget
+    '''
+    pass
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def record_statement(conn, cursor, statement, parameters, context, executemany):
+    '''Record the statement when the current request is being counted'''
+    if has_request_context() and 'query_log' in g:
+        g.query_log.append(statement)
+
+def query_budget(max_queries):
+    '''@INPUTS
+    max_queries: the most SQL statements the route may run per request
+
+    Response:
+        Returns the decorator which declares the budget on the route
+        Stack it with requires_auth, the budget is copied to the wrapper
+    '''
+    def query_budget_decorator(f):
+        f.query_budget = max_queries
+        return f
+
+    return query_budget_decorator
+
+def allow_queries(count):
+    '''@INPUTS
+    count: the number of SQL statements to add to the current budget
+
+    Request:
+        Used by code wrapping a route (i.e. @idempotent) that runs its own
+        statements, so they are not charged to the route's budget
+    '''
+    if has_request_context() and 'query_log' in g:
+        g.query_allowance = g.get('query_allowance', 0) + count
+
+def init_query_budget(app):
+    '''@INPUTS
+    app: the Flask app whose routes declare a query_budget
+
+    Request:
+        Counts SQL statements for every request in testing or debug mode
+        (app.testing, app.debug or ENV=test)
+
+    Response:
+        When a route runs more statements than its budget:
+        Raises QueryBudgetExceeded in testing so the test fails
+        Logs an error with the statements in debug mode
+    '''
+    def strict():
+        return app.testing or os.getenv('ENV') == 'test'
+
+    @app.before_request
+    def start_query_log():
+        if strict() or app.debug:
+            g.query_log = []
+
+    @app.after_request
+    def check_query_budget(response):
+        if 'query_log' not in g:
+            return response
+
+        view = app.view_functions.get(request.endpoint)
+        budget = getattr(view, 'query_budget', None)
+        if budget is None:
+            return response
+        budget += g.get('query_allowance', 0)
+        if len(g.query_log) <= budget:
+            return response
+
+        message = (
+            f'{request.method} {request.path} ran {len(g.query_log)} SQL '
+            f'statements, budget is {budget}:\n' + '\n'.join(g.query_log)
+        )
+        if strict():
+            raise QueryBudgetExceeded(message)
+        app.logger.error(message)
+        return response
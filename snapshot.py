@@ -0,0 +1,240 @@
+import os
+import sys
+import time
+import threading
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import func, or_
+
+from models import db, movie_rows, movie_rows_by_ids, MovieChange
+
+#----------------------------------------------------------------------------#
+# Configure snapshot constants
+#----------------------------------------------------------------------------#
+
+MOVIE_SNAPSHOT = os.getenv('MOVIE_SNAPSHOT') == 'true'
+MOVIE_SNAPSHOT_REFRESH = float(os.getenv('MOVIE_SNAPSHOT_REFRESH', 1))
+MOVIE_SNAPSHOT_RELOAD = float(os.getenv('MOVIE_SNAPSHOT_RELOAD', 300))
+MOVIE_SNAPSHOT_GAP_TIMEOUT = float(os.getenv('MOVIE_SNAPSHOT_GAP_TIMEOUT', 60))
+MOVIE_SNAPSHOT_GAP_WINDOW = 1000
+
+# SQL statements in a full load, the most a snapshot read can run
+SNAPSHOT_LOAD_QUERIES = 3
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+#----------------------------------------------------------------------------#
+# Columnar movie snapshot
+#----------------------------------------------------------------------------#
+
+class MovieSnapshot:
+    '''
+    MovieSnapshot
+    A per-worker copy of the movies table kept in parallel arrays ordered by id
+        ids: array of movie ids
+        titles: list of titles
+        release_dates: array of release dates in microseconds since the epoch
+        positions: map of movie id to its index in the arrays
+    Refreshed from the movie_changes log at most every refresh seconds and
+    reloaded in full every reload seconds, pruning the log on each reload
+
+    movie_changes ids are handed out when a write starts but only become
+    visible when it commits, so a lower id can show up after a higher one.
+    Ids missing below the highest id seen are kept in gaps and read again
+    on each refresh for gap_timeout seconds
+    '''
+    def __init__(self, refresh=MOVIE_SNAPSHOT_REFRESH,
+                 reload=MOVIE_SNAPSHOT_RELOAD,
+                 gap_timeout=MOVIE_SNAPSHOT_GAP_TIMEOUT):
+        self.refresh_interval = refresh
+        self.reload_interval = reload
+        self.gap_timeout = gap_timeout
+        self.ids = array('q')
+        self.titles = []
+        self.release_dates = array('q')
+        self.positions = {}
+        self.last_change = None
+        self.gaps = {}
+        self.checked_at = None
+        self.loaded_at = None
+        self._lock = threading.Lock()
+
+    '''
+    refresh()
+        Brings the snapshot up to date if the refresh interval has passed
+        Loads the whole table on first use and every reload interval,
+        otherwise applies the movie_changes rows written since the last check
+    '''
+    def refresh(self):
+        now = time.monotonic()
+        if self._fresh(now):
+            return
+
+        with self._lock:
+            if self._fresh(now):
+                return
+            if self.loaded_at is None or \
+                    now - self.loaded_at >= self.reload_interval:
+                self._load(now)
+                self.loaded_at = now
+            else:
+                self._apply_changes(now)
+            self.checked_at = now
+
+    '''
+    all()
+        Returns every movie in the snapshot as an object ordered by id
+    '''
+    def all(self):
+        with self._lock:
+            return [self._format(i) for i in range(len(self.ids))]
+
+    '''
+    get(id)
+        Returns the movie matching the id as an object, or None
+    '''
+    def get(self, id):
+        with self._lock:
+            i = self.positions.get(id)
+            if i is None:
+                return None
+            return self._format(i)
+
+    '''
+    memory_per_row()
+        Returns the bytes held by the snapshot per movie
+    '''
+    def memory_per_row(self):
+        with self._lock:
+            return self._memory_per_row()
+
+    def _memory_per_row(self):
+        if not self.ids:
+            return 0
+        size = sys.getsizeof(self.ids) + \
+            sys.getsizeof(self.release_dates) + \
+            sys.getsizeof(self.titles) + \
+            sum(sys.getsizeof(title) for title in self.titles) + \
+            sys.getsizeof(self.positions) + \
+            sum(sys.getsizeof(id) for id in self.positions)
+        return size / len(self.ids)
+
+    def _fresh(self, now):
+        return self.checked_at is not None and \
+            now - self.checked_at < self.refresh_interval
+
+    def _load(self, now):
+        # Read the log position first so changes racing the load are
+        # applied again on the next refresh. The recent ids show which
+        # writes below the last one have not committed yet
+        last_id = db.session.query(func.max(MovieChange.id)).scalar_subquery()
+        recent = db.session.query(MovieChange.id, MovieChange.created_at) \
+            .filter(MovieChange.id > last_id - MOVIE_SNAPSHOT_GAP_WINDOW).all()
+        seen = {id for id, _ in recent}
+        last_change = max(seen, default=0)
+
+        # Ids missing below a change older than gap_timeout were pruned or
+        # rolled back, not still running, so gaps are only seeded above it
+        cutoff = datetime.utcnow() - timedelta(seconds=self.gap_timeout)
+        settled = [id for id, created_at in recent if created_at < cutoff]
+        start = max(settled, default=min(seen, default=1) - 1)
+        rows = movie_rows()
+
+        # Every worker reloads at least every reload seconds, so changes
+        # twice that old are already part of every snapshot
+        MovieChange.prune(
+            datetime.utcnow() - timedelta(seconds=2 * self.reload_interval)
+        )
+        db.session.commit()
+
+        self.ids = array('q', (row[0] for row in rows))
+        self.titles = [row[1] for row in rows]
+        self.release_dates = array(
+            'q', ((row[2] - EPOCH) // MICROSECOND for row in rows)
+        )
+        self.positions = {id: i for i, id in enumerate(self.ids)}
+        self.last_change = 0
+        self.gaps = {}
+        self._track_gaps(seen, start, last_change, now)
+
+        current_app.logger.info(
+            'Movie snapshot loaded %d movies, %.1f bytes per row',
+            len(self.ids), self._memory_per_row()
+        )
+
+    def _apply_changes(self, now):
+        self.gaps = {
+            id: seen_at for id, seen_at in self.gaps.items()
+            if now - seen_at < self.gap_timeout
+        }
+        new_changes = MovieChange.id > self.last_change
+        if self.gaps:
+            new_changes = or_(new_changes, MovieChange.id.in_(self.gaps))
+        changes = db.session.query(MovieChange.id, MovieChange.movie_id) \
+            .filter(new_changes).all()
+        if not changes:
+            return
+
+        seen = {id for id, _ in changes}
+        for id in seen:
+            self.gaps.pop(id, None)
+        # An empty log at load time leaves no position to count gaps from
+        start = self.last_change or min(seen) - 1
+        self._track_gaps(seen, start, max(seen), now)
+
+        movie_ids = {movie_id for _, movie_id in changes}
+        rows = movie_rows_by_ids(movie_ids)
+
+        found = {row[0]: row for row in rows}
+        for movie_id in movie_ids:
+            if movie_id in found:
+                self._upsert(*found[movie_id])
+            else:
+                self._remove(movie_id)
+
+    def _track_gaps(self, seen, start, last_change, now):
+        # Ids between start and the new last change that did not show up
+        # belong to writes still running (or rolled back)
+        start = max(start, last_change - MOVIE_SNAPSHOT_GAP_WINDOW)
+        for id in range(start + 1, last_change):
+            if id not in seen:
+                self.gaps.setdefault(id, now)
+        self.last_change = max(self.last_change, last_change)
+
+    def _upsert(self, id, title, release_date):
+        release_date = (release_date - EPOCH) // MICROSECOND
+        i = self.positions.get(id)
+        if i is not None:
+            self.titles[i] = title
+            self.release_dates[i] = release_date
+            return
+
+        # New ids are almost always the largest, so this is usually an append
+        i = bisect_left(self.ids, id)
+        self.ids.insert(i, id)
+        self.titles.insert(i, title)
+        self.release_dates.insert(i, release_date)
+        self._reindex(i)
+
+    def _remove(self, id):
+        i = self.positions.pop(id, None)
+        if i is None:
+            return
+        del self.ids[i]
+        del self.titles[i]
+        del self.release_dates[i]
+        self._reindex(i)
+
+    def _reindex(self, start):
+        for i in range(start, len(self.ids)):
+            self.positions[self.ids[i]] = i
+
+    def _format(self, i):
+        return {
+            'id': self.ids[i],
+            'title': self.titles[i],
+            'release_date': EPOCH + self.release_dates[i] * MICROSECOND
+        }
@@ -3,7 +3,9 @@ import unittest
 import json
 from flask_sqlalchemy import SQLAlchemy
 from app import create_app
-from models import setup_db, Actor, Movie
+from models import setup_db, rebuild_movie_stats, Actor, Movie, MovieChange, db
+from snapshot import MovieSnapshot
+from auth import ANY_SIGNED_IN
 
 #Insert JWT Constants for each role
 EXECUTIVE_PRODUCER=''
@@ -13,7 +15,9 @@ class CastingAgencyTestCase(unittest.TestCase):
 
     def setUp(self) -> None:
         '''Define test variables and initialize app'''
-        self.app = create_app()
+        # TESTING makes the query budget guard fail the test on a route
+        # running more SQL statements than its @query_budget
+        self.app = create_app({'TESTING': True})
         self.client = self.app.test_client
 
         # Set up database
@@ -56,6 +60,65 @@ class CastingAgencyTestCase(unittest.TestCase):
         #check that number of movies increases by 1
         self.assertTrue(len(num_movies_after) - len(num_movies_before) == 1)
     
+    def test_add_movie_idempotency_key(self):
+        '''Tests a repeated Idempotency-Key returns the first movie without inserting again'''
+
+        num_movies_before = Movie.query.all()
+
+        headers = {
+            "Authorization": "Bearer " + EXECUTIVE_PRODUCER,
+            "Idempotency-Key": "test-add-movie-idempotency-key"
+        }
+        first = self.client().post('/movies', json=self.test_movie, headers=headers)
+        retry = self.client().post('/movies', json=self.test_movie, headers=headers)
+
+        num_movies_after = Movie.query.all()
+
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(json.loads(retry.data), json.loads(first.data))
+        #check that number of movies increases by 1 only
+        self.assertTrue(len(num_movies_after) - len(num_movies_before) == 1)
+
+    def test_add_movie_idempotency_key_across_processes(self):
+        '''Tests a retry reaching another server process still returns the first movie'''
+
+        num_movies_before = Movie.query.all()
+
+        headers = {
+            "Authorization": "Bearer " + EXECUTIVE_PRODUCER,
+            "Idempotency-Key": "test-add-movie-idempotency-key-across-processes"
+        }
+        # Each app has its own IdempotencyStore, like separate gunicorn workers
+        other_app = create_app({'TESTING': True})
+        setup_db(other_app, self.database_path)
+        first = self.client().post('/movies', json=self.test_movie, headers=headers)
+        retry = other_app.test_client().post('/movies', json=self.test_movie, headers=headers)
+
+        num_movies_after = Movie.query.all()
+
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(json.loads(retry.data), json.loads(first.data))
+        #check that number of movies increases by 1 only
+        self.assertTrue(len(num_movies_after) - len(num_movies_before) == 1)
+
+    def test_422_add_movie_idempotency_key_reused(self):
+        '''Tests reusing an Idempotency-Key with a different body sends 422'''
+
+        headers = {
+            "Authorization": "Bearer " + EXECUTIVE_PRODUCER,
+            "Idempotency-Key": "test-add-movie-idempotency-key-reused"
+        }
+        self.client().post('/movies', json=self.test_movie, headers=headers)
+        res = self.client().post('/movies', json={'title': 'Other', 'release_date': '2020-01-01'}, headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'unprocessable')
+
     def test_400_add_movie_fails(self):
         '''Tests add_movie failure sends 422'''
 
@@ -83,6 +146,149 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
 
+    def get_year_counts(self):
+        '''Returns the /movies/stats year counts as a dict of year to count'''
+
+        res = self.client().get('/movies/stats', headers={"Authorization": "Bearer " + EXECUTIVE_PRODUCER})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        return {year['year']: year['count'] for year in data['stats']['years']}
+
+    def test_get_movie_stats(self):
+        '''Tests get_movie_stats matches the movies table'''
+
+        res = self.client().get('/movies/stats', headers={"Authorization": "Bearer " + EXECUTIVE_PRODUCER})
+        data = json.loads(res.data)
+
+        num_movies = Movie.query.all()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['stats']['total_movies'], len(num_movies))
+
+    def test_movie_stats_maintained_by_writes(self):
+        '''Tests movie writes keep the year counts up to date and match a rebuild'''
+
+        headers = {"Authorization": "Bearer " + EXECUTIVE_PRODUCER}
+        counts = self.get_year_counts()
+
+        # POST adds one movie to 2007
+        res = self.client().post('/movies', json=self.test_movie, headers=headers)
+        movie_id = json.loads(res.data)['movie']['id']
+        after_post = self.get_year_counts()
+        self.assertEqual(after_post.get(2007, 0), counts.get(2007, 0) + 1)
+
+        # PATCH moves it from 2007 to 1960
+        res = self.client().patch(f'/movies/{movie_id}', json={'title': 'La Vie En Rose', 'release_date': '1960-07-20'}, headers=headers)
+        self.assertEqual(res.status_code, 200)
+        after_patch = self.get_year_counts()
+        self.assertEqual(after_patch.get(2007, 0), counts.get(2007, 0))
+        self.assertEqual(after_patch.get(1960, 0), counts.get(1960, 0) + 1)
+
+        # DELETE removes it from 1960
+        res = self.client().delete(f'/movies/{movie_id}', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        after_delete = self.get_year_counts()
+        self.assertEqual(after_delete.get(1960, 0), counts.get(1960, 0))
+
+        # A rebuild from the movies table gives the same counts
+        with self.app.app_context():
+            rebuild_movie_stats()
+        self.assertEqual(self.get_year_counts(), after_delete)
+
+    def test_delete_deleted_movie_keeps_movie_stats(self):
+        '''Tests deleting an already deleted movie leaves the year counts unchanged'''
+
+        headers = {"Authorization": "Bearer " + EXECUTIVE_PRODUCER}
+        counts = self.get_year_counts()
+
+        res = self.client().post('/movies', json=self.test_movie, headers=headers)
+        movie_id = json.loads(res.data)['movie']['id']
+        res = self.client().delete(f'/movies/{movie_id}', headers=headers)
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().delete(f'/movies/{movie_id}', headers=headers)
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(self.get_year_counts(), counts)
+
+    def snapshot_app(self):
+        '''Returns an app with the movie snapshot on, so movie writes log to movie_changes'''
+
+        app = create_app({'TESTING': True, 'MOVIE_SNAPSHOT': True})
+        setup_db(app, self.database_path)
+        return app
+
+    def test_movie_snapshot(self):
+        '''Tests the movie snapshot matches the database after a write'''
+
+        app = self.snapshot_app()
+
+        with app.app_context():
+            snapshot = MovieSnapshot(refresh=0)
+            snapshot.refresh()
+
+            app.test_client().post('/movies', json=self.test_movie, headers={"Authorization": "Bearer " + EXECUTIVE_PRODUCER})
+            snapshot.refresh()
+
+            movies = Movie.query.order_by(Movie.id).all()
+            self.assertEqual(snapshot.all(), [movie.format() for movie in movies])
+            self.assertEqual(snapshot.get(movies[-1].id), movies[-1].format())
+            self.assertIsNone(snapshot.get(9999))
+            self.assertTrue(snapshot.memory_per_row() > 0)
+
+    def test_movie_snapshot_update_and_delete(self):
+        '''Tests the movie snapshot picks up an updated and a deleted movie'''
+
+        app = self.snapshot_app()
+        headers = {"Authorization": "Bearer " + EXECUTIVE_PRODUCER}
+
+        with app.app_context():
+            snapshot = MovieSnapshot(refresh=0)
+            res = app.test_client().post('/movies', json=self.test_movie, headers=headers)
+            movie_id = json.loads(res.data)['movie']['id']
+            snapshot.refresh()
+
+            app.test_client().patch(f'/movies/{movie_id}', json={'title': 'La Môme', 'release_date': '2007-02-14'}, headers=headers)
+            snapshot.refresh()
+            self.assertEqual(snapshot.get(movie_id), Movie.query.get(movie_id).format())
+            self.assertEqual(snapshot.get(movie_id)['title'], 'La Môme')
+
+            app.test_client().delete(f'/movies/{movie_id}', headers=headers)
+            snapshot.refresh()
+            self.assertIsNone(snapshot.get(movie_id))
+
+    def test_movie_snapshot_applies_late_change(self):
+        '''Tests a change committed after a later change is still applied'''
+
+        app = self.snapshot_app()
+        headers = {"Authorization": "Bearer " + EXECUTIVE_PRODUCER}
+
+        with app.app_context():
+            snapshot = MovieSnapshot(refresh=0)
+            res = app.test_client().post('/movies', json=self.test_movie, headers=headers)
+            updated_id = json.loads(res.data)['movie']['id']
+            res = app.test_client().post('/movies', json=self.test_movie, headers=headers)
+            deleted_id = json.loads(res.data)['movie']['id']
+            snapshot.refresh()
+
+            app.test_client().delete(f'/movies/{deleted_id}', headers=headers)
+            late_change = db.session.query(db.func.max(MovieChange.id)).scalar()
+            app.test_client().patch(f'/movies/{updated_id}', json={'title': 'La Môme', 'release_date': '2007-02-14'}, headers=headers)
+
+            # Hide the delete as if it had not committed yet
+            MovieChange.query.filter_by(id=late_change).update({'id': -late_change})
+            db.session.commit()
+            snapshot.refresh()
+            self.assertEqual(snapshot.get(updated_id)['title'], 'La Môme')
+            self.assertIsNotNone(snapshot.get(deleted_id))
+
+            # The delete commits after the update and is read from the gaps
+            MovieChange.query.filter_by(id=-late_change).update({'id': late_change})
+            db.session.commit()
+            snapshot.refresh()
+            self.assertIsNone(snapshot.get(deleted_id))
+
     def test_get_movie_by_id(self):
         '''Tests getting movie by id'''
 
@@ -179,9 +385,45 @@ class CastingAgencyTestCase(unittest.TestCase):
         # check number of movies is one less
         self.assertTrue(len(num_movies_before) == len(num_movies_after))
 
+#----------------------------------------------------------------------------#
+# Query Budget Tests
+#----------------------------------------------------------------------------#
+    def test_every_route_has_query_budget(self):
+        '''Tests every route declares a query budget'''
+
+        for rule in self.app.url_map.iter_rules():
+            if rule.endpoint == 'static':
+                continue
+            view = self.app.view_functions[rule.endpoint]
+            self.assertIsNotNone(
+                getattr(view, 'query_budget', None),
+                f'{rule.rule} has no @query_budget'
+            )
+
 #----------------------------------------------------------------------------#
 # Authorization Tests
 #----------------------------------------------------------------------------#
+    def test_get_permissions(self):
+        '''Tests the permission registry lists the movie routes with their permissions'''
+
+        res = self.client().get('/permissions', headers={"Authorization": "Bearer " + EXECUTIVE_PRODUCER})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertIn(
+            {'route': '/movies', 'methods': ['POST'], 'permission': 'post:movies'},
+            data['routes']
+        )
+        self.assertIn(
+            {'route': '/movies/<int:id>', 'methods': ['DELETE'], 'permission': 'delete:movies'},
+            data['routes']
+        )
+        self.assertIn(
+            {'route': '/permissions', 'methods': ['GET'], 'permission': ANY_SIGNED_IN},
+            data['routes']
+        )
+
     def test_unauthorised_add_actors_assistant(self):
         '''test auth failure: assistant - no post:actors'''
         response= self.client().post(